@@ -11,19 +11,40 @@ __all__ = [
     "get_from_cache",
 ]
 
+import contextlib
+import errno
+import functools
+import hashlib
+import json
 import os
+import queue
 import re
 import shutil
 import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Union
 from urllib.parse import urlparse
 
 import requests
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 from ..core import logger
 
+try:
+    import libarchive
+except ImportError:
+    libarchive = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 PRETRAINED_BERT_MODEL_DIR = {
     'en': 'bert-base-cased.zip',
     'en-large-cased-wwm': 'bert-large-cased-wwm.zip',
@@ -143,6 +164,50 @@ PRETRAIN_MAP = {'elmo': PRETRAINED_ELMO_MODEL_DIR,
                 'gpt2': PRETRAINED_GPT2_MODEL_DIR,
                 'roberta': PRETRAINED_ROBERTA_MODEL_DIR}
 
+# 默认的下载地址, 可以通过环境变量FASTNLP_{NAME}_URL修改
+_BASE_URLS = {
+    'embedding': "http://212.129.155.247/embedding/",
+    "dataset": "http://212.129.155.247/dataset/"
+}
+
+# 下载时每次从网络读取的字节数以及写入文件时的缓冲区大小
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+_WRITE_BUFFER_SIZE = 2 * 1024 * 1024
+# 下载线程与写入线程之间最多缓存的chunk数量
+_DOWNLOAD_QUEUE_SIZE = 16
+# 服务器支持Range请求且文件大于该值时, 使用多个连接并行下载
+_PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+_PARALLEL_DOWNLOAD_WORKERS = 4
+# 一边下载一边解压的tar.gz/tar.zst大于该值时, 同时将压缩包写入.partials中以便中断后继续下载
+_RESUMABLE_STREAM_THRESHOLD = 64 * 1024 * 1024
+# 并行下载时每下载这么多字节记录一次各段的进度, 进程被kill之后最多需要重新下载这么多
+_PARTIAL_SAVE_BYTES = 16 * 1024 * 1024
+# 解压zip时使用的线程数
+_UNZIP_WORKERS = min(8, os.cpu_count() or 1)
+# 累计下载这么多字节之后才更新一次进度条
+_PROGRESS_UPDATE_BYTES = 1024 * 1024
+
+# 下载或解压被中断(例如进程被kill)后遗留在cache_dir中的.tmp临时文件(夹), 超过该时间(1天)没有修改时会在下次下载时删除
+_STALE_TEMP_SECONDS = 24 * 60 * 60
+
+# match_file对各个cache_dir的扫描结果, {cache_dir: (文件夹的修改时间, _scan_match_names的结果)}
+_MATCH_CACHE = {}
+# 文件夹的修改时间距现在超过该值(2秒)时才缓存其扫描结果
+_MATCH_CACHE_MIN_AGE_NS = 2 * 10 ** 9
+
+# 下载或解压.tar.zst版本失败的url, 之后只下载原始的压缩包
+_ZST_FAILED_URLS = set()
+
+# 下载使用的requests.Session, 由_get_session在第一次使用时创建
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+# cached_path在当前进程中已经解析过的结果, key为(url_or_filename, 缓存文件夹)
+_RESOLVED_PATHS = OrderedDict()
+# 最多记录这么多个结果, 超过时丢弃最久没有使用的
+_RESOLVED_PATHS_MAXSIZE = 256
+_RESOLVED_PATHS_LOCK = threading.Lock()
+
 #  用于扩展fastNLP的下载
 FASTNLP_EXTEND_DATASET_URL = 'fastnlp_dataset_url.txt'
 FASTNLP_EXTEND_EMBEDDING_URL = {'elmo': 'fastnlp_elmo_url.txt',
@@ -153,7 +218,7 @@ FASTNLP_EXTEND_EMBEDDING_URL = {'elmo': 'fastnlp_elmo_url.txt',
                                 }
 
 
-def cached_path(url_or_filename: str, cache_dir: str = None, name=None) -> Path:
+def cached_path(url_or_filename: str, cache_dir: str = None, name=None, refresh: bool = False) -> Path:
     r"""
     给定一个url，尝试通过url中的解析出来的文件名字filename到{cache_dir}/{name}/{filename}下寻找这个文件，
     
@@ -170,25 +235,55 @@ def cached_path(url_or_filename: str, cache_dir: str = None, name=None) -> Path:
     :param str url_or_filename: 文件的下载url或者文件名称。
     :param str cache_dir: 文件的缓存文件夹。如果为None，将使用"~/.fastNLP"这个默认路径
     :param str name: 中间一层的名称。如embedding, dataset
+    :param bool refresh: 为True时, 即使url对应的资源已经缓存, 也会向服务器确认资源是否有更新, 有更新则重新下载。
+        默认为False, 此时只检查本地文件是否存在
     :return:
     """
     if cache_dir is None:
-        data_cache = Path(get_cache_path())
+        data_cache = get_cache_path()
     else:
         data_cache = cache_dir
 
     if name:
         data_cache = os.path.join(data_cache, name)
 
+    # 同一个进程中再次解析同一个资源时直接使用之前的结果, 只需要确认该路径仍然存在。只有成功的结果会被记录
+    key = (url_or_filename, str(data_cache))
+    if not refresh:
+        with _RESOLVED_PATHS_LOCK:
+            path = _RESOLVED_PATHS.get(key)
+            if path is not None:
+                _RESOLVED_PATHS.move_to_end(key)
+        if path is not None and os.path.exists(path):
+            return path
+    path = _resolve_path(url_or_filename, data_cache, refresh)
+    with _RESOLVED_PATHS_LOCK:
+        _RESOLVED_PATHS[key] = path
+        _RESOLVED_PATHS.move_to_end(key)
+        if len(_RESOLVED_PATHS) > _RESOLVED_PATHS_MAXSIZE:
+            _RESOLVED_PATHS.popitem(last=False)
+    return path
+
+
+def _resolve_path(url_or_filename: str, data_cache: str, refresh: bool = False) -> Path:
+    r"""
+    cached_path的实际实现, 在data_cache中寻找或下载url_or_filename
+
+    :param str url_or_filename: 文件的下载url或者文件名称。
+    :param str data_cache: 文件所在的文件夹
+    :param bool refresh: 是否向服务器确认资源是否有更新
+    :return:
+    """
     parsed = urlparse(url_or_filename)
 
     if parsed.scheme in ("http", "https"):
         # URL, so get it from the cache (downloading if necessary)
-        return get_from_cache(url_or_filename, Path(data_cache))
-    elif parsed.scheme == "" and Path(os.path.join(data_cache, url_or_filename)).exists():
-        # File, and it exists.
-        return Path(os.path.join(data_cache, url_or_filename))
+        return get_from_cache(url_or_filename, data_cache, refresh=refresh)
     elif parsed.scheme == "":
+        full_path = os.path.join(data_cache, url_or_filename)
+        if os.path.exists(full_path):
+            # File, and it exists.
+            return Path(full_path)
         # File, but it doesn't exist.
         raise FileNotFoundError("file {} not found in {}.".format(url_or_filename, data_cache))
     else:
@@ -214,11 +309,12 @@ def get_filepath(filepath):
     :return:
     """
     if os.path.isdir(filepath):
-        files = os.listdir(filepath)
-        if len(files) == 1:
-            return os.path.join(filepath, files[0])
-        else:
-            return filepath
+        # 只需要知道是否恰好有一个文件, 读到第二个就可以停止
+        with os.scandir(filepath) as it:
+            first = next(it, None)
+            if first is not None and next(it, None) is None:
+                return os.path.join(filepath, first.name)
+        return filepath
     elif os.path.isfile(filepath):
         return filepath
     else:
@@ -258,13 +354,10 @@ def _get_base_url(name):
         else:
             return url + '/'
     else:
-        URLS = {
-            'embedding': "http://212.129.155.247/embedding/",
-            "dataset": "http://212.129.155.247/dataset/"
-        }
-        if name.lower() not in URLS:
+        url = _BASE_URLS.get(name.lower(), None)
+        if url is None:
             raise KeyError(f"{name} is not recognized.")
-        return URLS[name.lower()]
+        return url
 
 
 def _get_embedding_url(embed_type, name):
@@ -302,16 +395,29 @@ def _read_extend_url_file(filename, name)->str:
     cache_dir = get_cache_path()
     filepath = os.path.join(cache_dir, filename)
     if os.path.exists(filepath):
-        with open(filepath, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    parts = line.split('\t')
-                    if len(parts) == 2:
-                        if name == parts[0]:
-                            return parts[1]
+        return _load_extend_url_file(filepath, os.stat(filepath).st_mtime_ns).get(name, None)
     return None
 
+
+@functools.lru_cache(maxsize=16)
+def _load_extend_url_file(filepath: str, mtime_ns: int) -> dict:
+    r"""
+    读取filepath中的全部名称与url。以文件的修改时间作为缓存的一部分, 文件修改后会重新读取
+
+    :param str filepath: 文件路径
+    :param int mtime_ns: 文件的修改时间
+    :return: dict, 名称到url的映射
+    """
+    urls = {}
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                parts = line.split('\t')
+                if len(parts) == 2:
+                    urls.setdefault(parts[0], parts[1])
+    return urls
+
 def _get_dataset_url(name):
     r"""
     给定dataset的名称，返回下载url
@@ -334,7 +440,7 @@ def _get_dataset_url(name):
 
 def split_filename_suffix(filepath):
     r"""
-    给定filepath 返回对应的name和suffix. 如果后缀是多个点，仅支持.tar.gz类型
+    给定filepath 返回对应的name和suffix. 如果后缀是多个点，仅支持.tar.gz和.tar.zst类型
     
     :param filepath: 文件路径
     :return: filename, suffix
@@ -342,10 +448,74 @@ def split_filename_suffix(filepath):
     filename = os.path.basename(filepath)
     if filename.endswith('.tar.gz'):
         return filename[:-7], '.tar.gz'
+    if filename.endswith('.tar.zst'):
+        return filename[:-8], '.tar.zst'
     return os.path.splitext(filename)
 
 
-def get_from_cache(url: str, cache_dir: Path = None) -> Path:
+def _get_session() -> requests.Session:
+    r"""
+    返回用于下载的session。整个进程共用一个session(第一次需要发送请求时才创建), 多次请求(包括失败后的重试)可以复用已经建立的TCP连接
+
+    :return: requests.Session
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=_PARALLEL_DOWNLOAD_WORKERS, max_retries=3)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({"User-Agent": "fastNLP"})
+            _SESSION = session
+        return _SESSION
+
+
+class _BatchedProgress:
+    r"""
+    对tqdm进度条的包装, 累计到_PROGRESS_UPDATE_BYTES字节后才真正更新一次, 减少下载循环中调用tqdm的开销。
+    不在终端中运行(例如输出被重定向到日志)时不显示进度条。可以在多个线程中同时使用
+    """
+
+    def __init__(self, total, initial=0):
+        self._progress = tqdm(unit="B", total=total, initial=initial, unit_scale=1, mininterval=0.5, disable=None)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def update(self, n):
+        with self._lock:
+            self._pending += n
+            if self._pending >= _PROGRESS_UPDATE_BYTES:
+                self._progress.update(self._pending)
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._pending:
+                self._progress.update(self._pending)
+                self._pending = 0
+        self._progress.close()
+
+
+class _ProgressReader:
+    r"""
+    对可读的文件对象进行包装, 每次read的时候同步更新进度条。传入copy_to时会把读到的内容同时写入copy_to中
+    """
+
+    def __init__(self, fileobj, progress, copy_to=None):
+        self._fileobj = fileobj
+        self._progress = progress
+        self._copy_to = copy_to
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._progress.update(len(data))
+        if self._copy_to is not None:
+            self._copy_to.write(data)
+        return data
+
+
+def get_from_cache(url: str, cache_dir: Union[str, Path] = None, refresh: bool = False) -> Path:
     r"""
     尝试在cache_dir中寻找url定义的资源; 如果没有找到; 则从url下载并将结果放在cache_dir下，缓存的名称由url的结果推断而来。会将下载的
     文件解压，将解压后的文件全部放在cache_dir文件夹中。
@@ -354,134 +524,818 @@ def get_from_cache(url: str, cache_dir: Path = None) -> Path:
     
     :param url: 资源的 url
     :param cache_dir: cache 目录
+    :param refresh: 为True时, 即使资源已经在cache_dir中, 也会根据下载时记录的ETag/Last-Modified向服务器确认资源是否有更新,
+        有更新则重新下载
     :return: 路径
     """
-    cache_dir.mkdir(parents=True, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
 
-    filename = re.sub(r".+/", "", url)
+    filename = urlparse(url).path.rsplit('/', 1)[-1]
     dir_name, suffix = split_filename_suffix(filename)
+    etag_path = os.path.join(cache_dir, f'.{dir_name}.etag.json')
 
     # 寻找与它名字匹配的内容, 而不关心后缀
     match_dir_name = match_file(dir_name, cache_dir)
-    if match_dir_name:
-        dir_name = match_dir_name
-    cache_path = cache_dir / dir_name
+    cache_path = os.path.join(cache_dir, match_dir_name or dir_name)
 
     # get cache path to put the file
-    if cache_path.exists():
-        return get_filepath(cache_path)
-
-    # make HEAD request to check ETag TODO ETag可以用来判断资源是否已经更新了，之后需要加上
-    # response = requests.head(url, headers={"User-Agent": "fastNLP"})
-    # if response.status_code != 200:
-    #     raise IOError(
-    #         f"HEAD request failed for url {url} with status code {response.status_code}."
-    #     )
-
-    # add ETag to filename if it exists
-    # etag = response.headers.get("ETag")
-
-    if not cache_path.exists():
-        # Download to temporary file, then copy to cache dir once finished.
-        # Otherwise you get corrupt cache entries if the download gets interrupted.
-        # GET file object
-        req = requests.get(url, stream=True, headers={"User-Agent": "fastNLP"})
+    stale_path = None
+    if os.path.exists(cache_path):
+        if not refresh or _is_cache_fresh(_get_session(), url, etag_path):
+            return Path(get_filepath(cache_path))
+        logger.info(f"{cache_path} is out of date, re-downloading from {url}")
+        stale_path = cache_path
+        cache_path = os.path.join(cache_dir, dir_name)
+
+    session = _get_session()
+    _remove_stale_temp_files(cache_dir)
+
+    # 服务器上同时提供了.tar.zst版本的压缩包时优先下载它, zstd的解压速度比zip/gz使用的DEFLATE快很多
+    download_url = url
+    if zstandard is not None and suffix in ('.zip', '.tar.gz'):
+        zst_url = _get_zst_url(session, url, suffix)
+        if zst_url is not None:
+            download_url, suffix = zst_url, '.tar.zst'
+
+    # 之前中断的下载保留在.partials中, 通过Range请求只下载剩余的部分. If-Range保证服务器上的文件变化之后会重新下载。
+    # 并行下载的文件(有.ranges记录)中间可能有空洞, 由_download_in_parallel根据.ranges继续下载
+    # 没有记录validator时无法确认服务器上的文件没有变化, 此时不继续下载
+    partial_path = _get_partial_path(cache_dir, download_url)
+    validator = _read_partial_validator(partial_path)
+    resume_from = 0
+    if validator is not None and os.path.isfile(partial_path) and not os.path.isfile(partial_path + '.ranges'):
+        resume_from = _get_partial_offset(partial_path)
+    headers = {}
+    if resume_from:
+        headers['Range'] = f'bytes={resume_from}-'
+        headers['If-Range'] = validator
+
+    # Download to temporary file, then move to cache dir once finished.
+    # Otherwise you get corrupt cache entries if the download gets interrupted.
+    # GET file object
+    req = session.get(download_url, stream=True, headers=headers)
+    partial_complete = False
+    if req.status_code in (206, 416):
+        content_range = _parse_content_range(req.headers)
+        if req.status_code == 416 and content_range == (None, resume_from):
+            # 已经下载完成, 中断发生在之后的解压或移动中, 直接使用已下载的文件
+            partial_complete = True
+        elif req.status_code == 416 or content_range is None or content_range[0] != resume_from:
+            # 已下载的部分不是服务器上当前文件的开头部分, 重新下载
+            req.close()
+            _remove_partial(partial_path)
+            resume_from = 0
+            req = session.get(download_url, stream=True)
+    if req.status_code in (200, 206) or partial_complete:
         if req.status_code == 200:
-            success = False
-            fd, temp_filename = tempfile.mkstemp()
-            uncompress_temp_dir = None
-            try:
-                content_length = req.headers.get("Content-Length")
-                total = int(content_length) if content_length is not None else None
-                progress = tqdm(unit="B", total=total, unit_scale=1)
-                logger.info("%s not found in cache, downloading to %s" % (url, temp_filename))
-
-                with open(temp_filename, "wb") as temp_file:
-                    for chunk in req.iter_content(chunk_size=1024 * 16):
-                        if chunk:  # filter out keep-alive new chunks
-                            progress.update(len(chunk))
-                            temp_file.write(chunk)
+            resume_from = 0
+        success = False
+        zst_failed = False
+        download_finished = False
+        temp_filename = None
+        uncompress_temp_dir = None
+        try:
+            content_length = req.headers.get("Content-Length")
+            if partial_complete:
+                total = resume_from
+            else:
+                total = int(content_length) + resume_from if content_length is not None else None
+            progress = _BatchedProgress(total, initial=resume_from)
+            parallel = req.status_code == 200 and _support_parallel_download(req, total)
+
+            # 临时文件(夹)都放在cache_dir下, 与cache_path位于同一个文件系统, 完成后只需要rename而不需要再复制一遍
+            if suffix in ('.tar.gz', '.tar.zst') and not parallel and not resume_from:
+                # tar.gz/tar.zst可以一边下载一边解压, 不需要先将整个压缩包写到临时文件中再读出来
+                uncompress_temp_dir = tempfile.mkdtemp(prefix='.tmp', dir=cache_dir)
+                logger.info("%s not found in cache, downloading and uncompressing to %s" %
+                            (download_url, uncompress_temp_dir))
+                req.raw.read = functools.partial(req.raw.read, decode_content=True)
+                untar_stream = untar_gz_stream if suffix == '.tar.gz' else untar_zst_stream
+                # 较大的压缩包同时写入.partials中, 中断之后可以从中断的位置继续下载(之后再从文件解压)。代价是多了一次
+                # 压缩包大小的磁盘写入, 因此较小的压缩包只一边下载一边解压, 中断之后重新下载
+                _remove_partial(partial_path)
+                if total is not None and total >= _RESUMABLE_STREAM_THRESHOLD:
+                    temp_filename = partial_path
+                    _write_partial_validator(partial_path, req.headers)
+                    with open(partial_path, 'wb', buffering=_WRITE_BUFFER_SIZE) as partial_file:
+                        untar_stream(_ProgressReader(req.raw, progress, partial_file), uncompress_temp_dir)
+                else:
+                    untar_stream(_ProgressReader(req.raw, progress), uncompress_temp_dir)
+                download_finished = True
+                progress.close()
+                logger.info(f"Finish download from {download_url}")
+            else:
+                temp_filename = partial_path
+                if partial_complete:
+                    req.close()
+                    logger.info("%s has already been downloaded to %s" % (download_url, temp_filename))
+                elif parallel:
+                    logger.info("%s not found in cache, downloading to %s" % (download_url, temp_filename))
+                    req.close()
+                    _download_in_parallel(session, download_url, temp_filename, total, progress,
+                                          _get_validator(req.headers))
+                else:
+                    if resume_from:
+                        logger.info("Resume downloading %s from byte %d" % (download_url, resume_from))
+                    else:
+                        logger.info("%s not found in cache, downloading to %s" % (download_url, temp_filename))
+                        _remove_partial(partial_path)
+                        _write_partial_validator(partial_path, req.headers)
+                    with open(temp_filename, "r+b" if resume_from else "wb", buffering=_WRITE_BUFFER_SIZE) as temp_file, \
+                            contextlib.closing(_iter_content_in_background(req)) as chunks:
+                        temp_file.seek(resume_from)
+                        # 预分配之后文件的大小不再是已经下载的字节数, 需要在.offset中定期记录写入的位置,
+                        # 进程被直接kill(来不及执行下面的truncate)之后从记录的位置继续下载
+                        preallocated = total is not None and \
+                                       _preallocate(temp_file.fileno(), resume_from, total - resume_from)
+                        if preallocated:
+                            _write_partial_offset(partial_path, resume_from)
+                        elif os.path.isfile(partial_path + '.offset'):
+                            os.remove(partial_path + '.offset')
+                        unsaved = 0
+                        try:
+                            for chunk in chunks:
+                                progress.update(len(chunk))
+                                temp_file.write(chunk)
+                                unsaved += len(chunk)
+                                if preallocated and unsaved >= _PARTIAL_SAVE_BYTES:
+                                    temp_file.flush()
+                                    _write_partial_offset(partial_path, temp_file.tell())
+                                    unsaved = 0
+                            # 旧版本的urllib3在连接提前断开时不会报错, 需要自己检查是否下载完整(内容经过
+                            # Content-Encoding压缩时, 解压后的大小与Content-Length不同, 无法检查)
+                            if total is not None and req.headers.get('Content-Encoding') is None and \
+                                    temp_file.tell() != total:
+                                raise IOError(f"Incomplete download from {download_url}: "
+                                              f"{temp_file.tell()} of {total} bytes received.")
+                        finally:
+                            # 去掉预分配但没有写入的部分, 保证中断后文件的大小就是已经下载的字节数
+                            temp_file.truncate()
+                            if preallocated:
+                                _write_partial_offset(partial_path, temp_file.tell())
+                download_finished = True
                 progress.close()
-                logger.info(f"Finish download from {url}")
+                logger.info(f"Finish download from {download_url}")
 
                 # 开始解压
-                if suffix in ('.zip', '.tar.gz', '.gz'):
-                    uncompress_temp_dir = tempfile.mkdtemp()
+                if suffix in ('.zip', '.tar.gz', '.tar.zst', '.gz'):
+                    uncompress_temp_dir = tempfile.mkdtemp(prefix='.tmp', dir=cache_dir)
                     logger.debug(f"Start to uncompress file to {uncompress_temp_dir}")
                     if suffix == '.zip':
-                        unzip_file(Path(temp_filename), Path(uncompress_temp_dir))
+                        unzip_file(temp_filename, uncompress_temp_dir)
                     elif suffix == '.gz':
                         ungzip_file(temp_filename, uncompress_temp_dir, dir_name)
+                    elif suffix == '.tar.zst':
+                        untar_zst_file(temp_filename, uncompress_temp_dir)
                     else:
-                        untar_gz_file(Path(temp_filename), Path(uncompress_temp_dir))
-                    filenames = os.listdir(uncompress_temp_dir)
-                    if len(filenames) == 1:
-                        if os.path.isdir(os.path.join(uncompress_temp_dir, filenames[0])):
-                            uncompress_temp_dir = os.path.join(uncompress_temp_dir, filenames[0])
-
-                    cache_path.mkdir(parents=True, exist_ok=True)
-                    logger.debug("Finish un-compressing file.")
-                else:
-                    uncompress_temp_dir = temp_filename
-                    cache_path = str(cache_path) + suffix
-
-                # 复制到指定的位置
-                logger.info(f"Copy file to {cache_path}")
-                if os.path.isdir(uncompress_temp_dir):
-                    for filename in os.listdir(uncompress_temp_dir):
-                        if os.path.isdir(os.path.join(uncompress_temp_dir, filename)):
-                            shutil.copytree(os.path.join(uncompress_temp_dir, filename), cache_path / filename)
-                        else:
-                            shutil.copyfile(os.path.join(uncompress_temp_dir, filename), cache_path / filename)
-                else:
-                    shutil.copyfile(uncompress_temp_dir, cache_path)
-                success = True
-            except Exception as e:
+                        untar_gz_file(temp_filename, uncompress_temp_dir)
+
+            if suffix in ('.zip', '.tar.gz', '.tar.zst', '.gz'):
+                src = uncompress_temp_dir
+                filenames = os.listdir(uncompress_temp_dir)
+                if len(filenames) == 1:
+                    if os.path.isdir(os.path.join(uncompress_temp_dir, filenames[0])):
+                        src = os.path.join(uncompress_temp_dir, filenames[0])
+                logger.debug("Finish un-compressing file.")
+            else:
+                src = temp_filename
+                cache_path = os.path.join(cache_dir, dir_name + suffix)
+
+            # 移动到指定的位置
+            if stale_path is not None:
+                _remove_path(stale_path)
+                stale_path = None
+            logger.info(f"Move file to {cache_path}")
+            _move_to_cache(src, cache_path)
+            _write_etag(etag_path, url, download_url, req.headers)
+            success = True
+        except Exception as e:
+            if download_url == url or not _is_uncompress_error(e):
                 logger.error(e)
                 raise e
-            finally:
-                if not success:
-                    if cache_path.exists():
-                        if cache_path.is_file():
-                            os.remove(cache_path)
-                        else:
-                            shutil.rmtree(cache_path)
-                os.close(fd)
+            zst_failed = True
+        finally:
+            # 旧的缓存还没有被删除时, cache_path指向的是旧的缓存, 不能删除
+            if not success and stale_path is None and os.path.exists(cache_path):
+                _remove_path(cache_path)
+            # 下载中断时保留.partials中的文件, 之后从中断的位置继续下载
+            if temp_filename == partial_path:
+                if download_finished or zst_failed:
+                    _remove_partial(partial_path)
+            elif temp_filename is not None and os.path.isfile(temp_filename):
                 os.remove(temp_filename)
-                if uncompress_temp_dir is None:
-                    pass
-                elif os.path.isdir(uncompress_temp_dir):
-                    shutil.rmtree(uncompress_temp_dir)
-                elif os.path.isfile(uncompress_temp_dir):
-                    os.remove(uncompress_temp_dir)
-            return get_filepath(cache_path)
+            if uncompress_temp_dir is not None and os.path.isdir(uncompress_temp_dir):
+                shutil.rmtree(uncompress_temp_dir)
+        if zst_failed:
+            logger.warning(f"Fail to uncompress {download_url}, download {url} instead.")
+            _ZST_FAILED_URLS.add(url)
+            return get_from_cache(url, cache_dir, refresh=refresh)
+        return Path(get_filepath(cache_path))
+    else:
+        raise HTTPError(f"Status code:{req.status_code}. Fail to download from {download_url}.")
+
+
+def _remove_stale_temp_files(cache_dir: str):
+    r"""
+    删除cache_dir中超过_STALE_TEMP_SECONDS没有修改的.tmp临时文件(夹)。正常情况下它们在get_from_cache结束时就会被删除,
+    只有进程被直接kill时才会遗留下来; 正在被其它进程使用的临时文件会持续被写入, 不会被误删
+
+    :param cache_dir: cache 目录
+    """
+    expire = time.time() - _STALE_TEMP_SECONDS
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.startswith('.tmp'):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < expire:
+                    _remove_path(entry.path)
+            except OSError:
+                # 可能已经被其它进程删除
+                pass
+
+
+def _get_partial_path(cache_dir: str, url: str) -> str:
+    r"""
+    返回url未下载完成时保存的文件路径, 位于cache_dir/.partials下, 文件名由url的sha1决定
+
+    :param cache_dir: cache 目录
+    :param url: 下载的url
+    :return: str
+    """
+    partial_dir = os.path.join(cache_dir, '.partials')
+    os.makedirs(partial_dir, exist_ok=True)
+    return os.path.join(partial_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def _get_validator(headers):
+    r"""
+    返回响应中的强ETag, 没有时返回Last-Modified, 都没有时返回None。可以作为If-Range使用, 确认之后的Range请求下载的仍然是同一个文件
+
+    :param headers: 响应的headers
+    :return: str或None
+    """
+    validator = headers.get('ETag')
+    if validator is None or validator.startswith('W/'):
+        validator = headers.get('Last-Modified')
+    return validator
+
+
+def _read_partial_validator(partial_path: str):
+    r"""
+    读取_write_partial_validator记录的validator
+
+    :param partial_path: 未下载完成的文件
+    :return: str, 没有记录时返回None
+    """
+    if not os.path.isfile(partial_path + '.validator'):
+        return None
+    with open(partial_path + '.validator', 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _parse_content_range(headers):
+    r"""
+    解析206响应中的Content-Range: bytes start-end/size, 或者416响应中的Content-Range: bytes */size
+
+    :param headers: 响应的headers
+    :return: (start, size), 416响应中start为None, size未知时为None; 没有或者无法解析时返回None
+    """
+    match = re.match(r'bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)$', headers.get('Content-Range', '').strip())
+    if match is None:
+        return None
+    start, size = match.groups()
+    return int(start) if start is not None else None, int(size) if size != '*' else None
+
+
+def _write_partial_validator(partial_path: str, headers):
+    r"""
+    记录开始下载时响应中的强ETag或Last-Modified, 继续下载时作为If-Range使用
+
+    :param partial_path: 未下载完成的文件
+    :param headers: 下载响应的headers
+    """
+    validator = _get_validator(headers)
+    if validator is not None:
+        with open(partial_path + '.validator', 'w', encoding='utf-8') as f:
+            f.write(validator)
+    elif os.path.isfile(partial_path + '.validator'):
+        os.remove(partial_path + '.validator')
+
+
+def _write_partial_offset(partial_path: str, offset: int):
+    r"""
+    记录未下载完成的文件中已经写入的字节数
+
+    :param partial_path: 未下载完成的文件
+    :param offset: 已经写入(并flush)的字节数
+    """
+    with open(partial_path + '.offset.tmp', 'w', encoding='utf-8') as f:
+        f.write(str(offset))
+    os.replace(partial_path + '.offset.tmp', partial_path + '.offset')
+
+
+def _get_partial_offset(partial_path: str) -> int:
+    r"""
+    返回未下载完成的文件中已经下载的字节数。文件经过预分配时以.offset中的记录为准, 否则就是文件的大小
+
+    :param partial_path: 未下载完成的文件
+    :return: int
+    """
+    size = os.path.getsize(partial_path)
+    if os.path.isfile(partial_path + '.offset'):
+        try:
+            with open(partial_path + '.offset', 'r', encoding='utf-8') as f:
+                return min(int(f.read()), size)
+        except ValueError:
+            return 0
+    return size
+
+
+def _remove_partial(partial_path: str):
+    r"""
+    删除未下载完成的文件及其记录的validator和已下载的范围
+
+    :param partial_path: 未下载完成的文件
+    """
+    for path in (partial_path, partial_path + '.validator', partial_path + '.ranges', partial_path + '.offset'):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _get_zst_url(session: requests.Session, url: str, suffix: str):
+    r"""
+    检查服务器上是否存在与url同名的.tar.zst压缩包, 例如 glove.6B.50d.zip 对应 glove.6B.50d.tar.zst。只对fastNLP的下载地址
+    (可以通过FASTNLP_{NAME}_URL修改)检查, 且之前解压失败过的url不再检查
+
+    :param session: 用于发送请求的session
+    :param url: 资源的 url
+    :param suffix: url的后缀, .zip或.tar.gz
+    :return: 存在时返回.tar.zst的url, 否则返回None
+    """
+    if url in _ZST_FAILED_URLS or not any(url.startswith(_get_base_url(name)) for name in _BASE_URLS):
+        return None
+    parsed = urlparse(url)
+    if not parsed.path.endswith(suffix):
+        return None
+    # 只替换path中的后缀, 保留query等部分
+    zst_url = parsed._replace(path=parsed.path[:-len(suffix)] + '.tar.zst').geturl()
+    try:
+        response = session.head(zst_url, allow_redirects=True)
+    except requests.RequestException:
+        return None
+    if response.status_code == 200:
+        return zst_url
+    return None
+
+
+def _is_uncompress_error(e: Exception) -> bool:
+    r"""
+    判断e是否是解压.tar.zst时由于压缩包本身有问题而产生的错误
+
+    :param e: 异常
+    :return: bool
+    """
+    import tarfile
+
+    errors = (tarfile.TarError, EOFError)
+    if zstandard is not None:
+        errors += (zstandard.ZstdError,)
+    if libarchive is not None:
+        errors += (libarchive.ArchiveError,)
+    return isinstance(e, errors)
+
+
+def _iter_content_in_background(req: requests.Response):
+    r"""
+    在后台线程中从网络读取req的内容并放入一个有界队列, 调用方在当前线程中从队列取出并写入磁盘, 使网络接收与磁盘写入可以同时进行
+    (两者在socket.recv和write中都会释放GIL)
+
+    :param req: stream=True的GET请求的响应
+    :return: 逐个返回下载内容的generator
+    """
+    chunks = queue.Queue(maxsize=_DOWNLOAD_QUEUE_SIZE)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in req.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    if not put(chunk):
+                        return
+            put(end)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    finished = False
+    try:
+        while True:
+            item = chunks.get()
+            if item is end:
+                finished = True
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        if finished:
+            thread.join()
+        else:
+            # 写入失败或者下载出错时, 关闭连接让后台线程尽快退出, 不等待它结束
+            req.close()
+
+
+def _support_parallel_download(req: requests.Response, total: int) -> bool:
+    r"""
+    根据GET请求的响应判断是否可以按Range分段并行下载: 需要服务器支持Range, 文件足够大, 且内容没有经过Content-Encoding压缩
+
+    :param req: GET请求的响应
+    :param total: 文件的大小, 未知时为None
+    :return: bool
+    """
+    return hasattr(os, 'pwrite') and total is not None and total >= _PARALLEL_DOWNLOAD_THRESHOLD and \
+           req.headers.get('Accept-Ranges') == 'bytes' and req.headers.get('Content-Encoding') is None
+
+
+def _download_in_parallel(session: requests.Session, url: str, filename: str, total: int,
+                          progress: '_BatchedProgress', validator: str = None):
+    r"""
+    将url对应的文件切分为_PARALLEL_DOWNLOAD_WORKERS段, 每段使用一个单独的连接通过Range请求下载, 并直接写入filename中对应的位置。
+    任意一段失败(或者被Ctrl-C中断)时, 其它段会在读完当前chunk后停止, 尚未开始的段不再下载。
+
+    每一段还没有下载的范围会记录在filename.ranges中, 中断之后再次调用时, 如果文件的大小和validator都没有变化, 只下载剩余的部分
+
+    :param session: 用于发送请求的session
+    :param url: 资源的 url
+    :param filename: 写入的文件, 会被预先扩展到total大小
+    :param total: 文件的大小
+    :param progress: 进度条
+    :param validator: 第一次GET响应中的强ETag或Last-Modified, 作为If-Range发送, 文件在下载过程中发生变化时服务器会返回200而不是206
+    """
+    ranges_path = filename + '.ranges'
+    pending = _load_pending_ranges(filename, total, validator)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT)
+    stop = threading.Event()
+    lock = threading.Lock()
+    unsaved = [0]
+
+    def save_pending():
+        # 先写入数据再更新pending, 因此记录中已下载的部分一定已经写入了文件
+        with lock:
+            with open(ranges_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'total': total, 'validator': validator,
+                           'pending': [[start, end] for start, end in pending if start < end]}, f)
+            os.replace(ranges_path + '.tmp', ranges_path)
+            unsaved[0] = 0
+
+    def download_range(part):
+        start, end = part
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+        if validator is not None:
+            headers['If-Range'] = validator
+        with contextlib.closing(session.get(url, stream=True, headers=headers)) as req:
+            if req.status_code != 206:
+                raise HTTPError(f"Status code:{req.status_code}. Fail to download bytes {start}-{end - 1} from {url}.")
+            for chunk in req.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+                if stop.is_set():
+                    return
+                if chunk:
+                    os.pwrite(fd, chunk, part[0])
+                    part[0] += len(chunk)
+                    progress.update(len(chunk))
+                    with lock:
+                        unsaved[0] += len(chunk)
+                        need_save = unsaved[0] >= _PARTIAL_SAVE_BYTES
+                    if need_save:
+                        save_pending()
+        if part[0] != end:
+            raise IOError(f"Incomplete download of bytes {start}-{end - 1} from {url}.")
+
+    executor = ThreadPoolExecutor(max_workers=_PARALLEL_DOWNLOAD_WORKERS)
+    futures = []
+    try:
+        if pending is None:
+            part_size = (total + _PARALLEL_DOWNLOAD_WORKERS - 1) // _PARALLEL_DOWNLOAD_WORKERS
+            pending = [[start, min(start + part_size, total)] for start in range(0, total, part_size)]
+            _preallocate(fd, 0, total)
+            os.ftruncate(fd, total)
+            save_pending()
         else:
-            raise HTTPError(f"Status code:{req.status_code}. Fail to download from {url}.")
+            progress.update(total - sum(end - start for start, end in pending))
+        futures = [executor.submit(download_range, part) for part in pending if part[0] < part[1]]
+        # 任意一段失败时立即返回, 而不是按顺序等待前面的段下载完成
+        wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future.done():
+                future.result()
+    except BaseException:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        os.close(fd)
+        if pending is not None:
+            save_pending()
+
+
+def _load_pending_ranges(filename: str, total: int, validator: str):
+    r"""
+    读取_download_in_parallel中断时在filename.ranges中记录的尚未下载的范围。文件的大小或validator发生了变化(或没有validator,
+    无法确认服务器上的文件没有变化)时返回None, 需要重新下载
+
+    :param filename: 下载的文件
+    :param total: 文件的大小
+    :param validator: 本次GET响应中的强ETag或Last-Modified
+    :return: [[start, end], ...]或None
+    """
+    if validator is None or not os.path.isfile(filename + '.ranges') or os.path.getsize(filename) != total:
+        return None
+    try:
+        with open(filename + '.ranges', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except ValueError:
+        return None
+    if meta.get('total') != total or meta.get('validator') != validator:
+        return None
+    return meta['pending']
+
+
+def _preallocate(fd: int, offset: int, length: int) -> bool:
+    r"""
+    已知下载文件的大小时, 通过posix_fallocate一次性为文件分配好磁盘空间, 得到连续的文件并减少写入过程中的元数据更新。
+    注意posix_fallocate会把文件扩展到offset+length的大小
+
+    :param fd: 文件描述符
+    :param offset: 开始分配的位置
+    :param length: 分配的字节数
+    :return: bool, 是否进行了预分配
+    """
+    if length > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, offset, length)
+            return True
+        except OSError:
+            # 部分文件系统不支持, 此时不预分配
+            pass
+    return False
+
+
+def _is_cache_fresh(session: requests.Session, url: str, etag_path: str) -> bool:
+    r"""
+    根据下载时记录在etag_path中的ETag/Last-Modified, 发送一个条件HEAD请求确认url对应的资源是否没有更新。没有记录时认为已经过期
+
+    :param session: 用于发送请求的session
+    :param url: 资源的 url
+    :param etag_path: 下载时记录ETag的文件
+    :return: bool, 缓存是否仍然有效。记录损坏或者无法连接服务器时继续使用已有的缓存
+    """
+    if not os.path.exists(etag_path):
+        return False
+    try:
+        with open(etag_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except ValueError as e:
+        logger.warning(f"Fail to read {etag_path}({e}), use the cached file without checking for updates.")
+        return True
+    if meta.get('url') != url:
+        return False
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    if not headers:
+        return False
+    try:
+        response = session.head(meta.get('download_url', url), headers=headers, allow_redirects=True)
+    except requests.RequestException as e:
+        logger.warning(f"Fail to check for updates of {url}({e}), use the cached file.")
+        return True
+    if response.status_code == 304:
+        return True
+    # 部分服务器不支持条件请求, 直接比较ETag
+    etag = response.headers.get('ETag')
+    return response.status_code == 200 and etag is not None and etag == meta.get('etag')
+
+
+def _write_etag(etag_path: str, url: str, download_url: str, headers):
+    r"""
+    将下载响应中的ETag/Last-Modified记录到etag_path中, 供之后refresh时使用
+
+    :param etag_path: 记录ETag的文件
+    :param url: 资源的 url
+    :param download_url: 实际下载的url, 下载的是.tar.zst版本时与url不同
+    :param headers: 下载响应的headers
+    """
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    if etag is None and last_modified is None:
+        if os.path.exists(etag_path):
+            os.remove(etag_path)
+        return
+    with open(etag_path, 'w', encoding='utf-8') as f:
+        json.dump({'etag': etag, 'last_modified': last_modified, 'url': url, 'download_url': download_url}, f)
+
+
+def _remove_path(path: str):
+    r"""
+    删除文件或文件夹
+
+    :param path: 需要删除的路径
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _move_to_cache(src: str, dst: str):
+    r"""
+    将下载或解压得到的src移动到dst。src与dst位于同一个文件系统时只需要rename, 否则退化为复制
+
+    :param src: 文件或文件夹
+    :param dst: 目标路径, 不能已经存在
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise e
+        # 只复制文件内容(Linux下shutil.copyfile会使用sendfile), 不需要像copy2那样保留权限和时间等元数据
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, copy_function=shutil.copyfile)
+        else:
+            shutil.copyfile(src, dst)
+
+
+def _extract_with_libarchive(file: Path, to: Path):
+    r"""
+    使用libarchive(C实现, 带缓冲的流式解压)将file解压到to中。libarchive只会解压到当前工作目录下, 因此这里把每个entry的路径
+    改写为to下的绝对路径, 而不去切换整个进程共享的工作目录
+
+    :param file: 压缩文件
+    :param to: 解压到的文件夹
+    """
+    from libarchive import extract
+
+    # 路径已经改写为绝对路径, 因此不能使用EXTRACT_SECURE_NOABSOLUTEPATHS; 包含'..'的路径仍然会被拒绝
+    flags = extract.EXTRACT_SECURE_NODOTDOT | extract.EXTRACT_SECURE_SYMLINKS
+    # EXTRACT_SECURE_SYMLINKS会检查路径中的每一级, to本身不能经过符号链接
+    to = os.path.realpath(to)
+    os.makedirs(to, exist_ok=True)
+
+    def entries_under_to(archive):
+        for entry in archive:
+            # 与tar一样去掉开头的'/', 使绝对路径也解压到to中
+            entry.pathname = os.path.join(to, entry.pathname.lstrip('/'))
+            if entry.islnk:
+                entry.linkpath = os.path.join(to, entry.linkpath.lstrip('/'))
+            yield entry
+
+    with libarchive.file_reader(str(file)) as archive:
+        extract.extract_entries(entries_under_to(archive), flags=flags)
 
 
 def unzip_file(file: Path, to: Path):
     # unpack and write out in CoNLL column-like format
+    if libarchive is not None:
+        _extract_with_libarchive(file, to)
+        return
+
     from zipfile import ZipFile
 
     with ZipFile(file, "r") as zipObj:
-        # Extract all the contents of zip file in current directory
-        zipObj.extractall(to)
+        infos = [info for info in zipObj.infolist() if not info.is_dir()]
+        num_workers = min(_UNZIP_WORKERS, len(infos))
+        if num_workers <= 1:
+            # Extract all the contents of zip file in current directory
+            zipObj.extractall(to)
+            return
+        # 先创建好所有的文件夹, 避免多个线程同时创建同一个文件夹时出错
+        for info in zipObj.infolist():
+            if info.is_dir():
+                zipObj.extract(info, to)
+            else:
+                os.makedirs(os.path.join(to, _zip_member_dir(info.filename)), exist_ok=True)
+
+    # ZipFile不能在多个线程之间共享, 每个线程单独打开一次(只会读取central directory); 解压时zlib会释放GIL
+    def extract(members):
+        with ZipFile(file, "r") as z:
+            for member in members:
+                z.extract(member, to)
+
+    # 按大小交错分配给各个线程, 使每个线程的解压量尽量接近
+    infos.sort(key=lambda info: info.file_size, reverse=True)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(extract, [infos[i::num_workers] for i in range(num_workers)]))
+
+
+def _zip_member_dir(filename: str) -> str:
+    r"""
+    按照ZipFile.extract处理路径的方式(去掉盘符, 空路径, '.'和'..'), 返回zip中的文件解压后所在的相对文件夹
 
+    :param filename: zip中文件的名称
+    :return: str, 相对文件夹, 位于顶层时为''
+    """
+    arcname = filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    parts = [x for x in arcname.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.join('', *parts[:-1])
 
-def untar_gz_file(file: Path, to: Path):
+
+def _extract_tar(tar, to: Path):
+    r"""
+    将已经打开的tar解压到to中
+
+    :param tar: tarfile.TarFile
+    :param to: 解压到的文件夹
+    """
     import tarfile
 
-    with tarfile.open(file, 'r:gz') as tar:
+    # tarfile默认每次只复制16KB
+    tar.copybufsize = _WRITE_BUFFER_SIZE
+    if hasattr(tarfile, 'data_filter'):
+        # 只解压普通的文件和文件夹, 不还原owner等信息, 并拒绝解压到to之外的路径
+        tar.extractall(to, filter='data')
+    else:
         tar.extractall(to)
 
 
+def untar_gz_stream(fileobj, to: Path):
+    r"""
+    从不可seek的文件对象(例如网络响应)中流式地读取并解压tar.gz
+
+    :param fileobj: 可读的文件对象
+    :param to: 解压到的文件夹
+    """
+    import tarfile
+
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+        _extract_tar(tar, to)
+
+
+def untar_zst_stream(fileobj, to: Path):
+    r"""
+    从不可seek的文件对象(例如网络响应)中流式地读取并解压tar.zst
+
+    :param fileobj: 可读的文件对象
+    :param to: 解压到的文件夹
+    """
+    if zstandard is None:
+        raise ImportError("zstandard is required to uncompress .tar.zst files, install it with `pip install zstandard`.")
+    import tarfile
+
+    dctx = zstandard.ZstdDecompressor(max_window_size=2 ** 31)
+    with dctx.stream_reader(fileobj) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+        _extract_tar(tar, to)
+
+
+def untar_zst_file(file: Path, to: Path):
+    if libarchive is not None:
+        _extract_with_libarchive(file, to)
+        return
+
+    with open(file, 'rb') as f:
+        untar_zst_stream(f, to)
+
+
+def untar_gz_file(file: Path, to: Path):
+    if libarchive is not None:
+        _extract_with_libarchive(file, to)
+        return
+
+    import gzip
+    import tarfile
+
+    # 按顺序读取一遍即可, 使用不可seek的'r|'模式
+    with gzip.open(file, 'rb') as gz, tarfile.open(fileobj=gz, mode='r|') as tar:
+        _extract_tar(tar, to)
+
+
 def ungzip_file(file: str, to: str, filename:str):
     import gzip
 
-    g_file = gzip.GzipFile(file)
-    with open(os.path.join(to, filename), 'wb+') as f:
-        f.write(g_file.read())
-    g_file.close()
+    # 分块复制, 不需要将解压后的整个文件读入内存
+    with gzip.open(file, 'rb') as g_file, open(os.path.join(to, filename), 'wb') as f:
+        shutil.copyfileobj(g_file, f, _WRITE_BUFFER_SIZE)
 
 
 def match_file(dir_name: str, cache_dir: Path) -> str:
@@ -493,11 +1347,19 @@ def match_file(dir_name: str, cache_dir: Path) -> str:
     :param cache_dir: 在该目录下找匹配dir_name是否存在
     :return str: 做为匹配结果的字符串
     """
-    files = os.listdir(cache_dir)
-    matched_filenames = []
-    for file_name in files:
-        if re.match(dir_name + '$', file_name) or re.match(dir_name + '\\..*', file_name):
-            matched_filenames.append(file_name)
+    # 文件夹中的内容有变化时它的修改时间也会变化, 因此只需要一次stat就可以判断之前的扫描结果是否还可用
+    cache_dir = os.fspath(cache_dir)
+    mtime_ns = os.stat(cache_dir).st_mtime_ns
+    cached = _MATCH_CACHE.get(cache_dir)
+    if cached is not None and cached[0] == mtime_ns:
+        names = cached[1]
+    else:
+        names = _scan_match_names(cache_dir)
+        # 刚刚被修改过的文件夹, 在修改时间精度较低的文件系统上可能在同一时刻内再次被修改, 此时不缓存
+        # (time.time_ns在python3.7中才加入)
+        if int(time.time() * 10 ** 9) - mtime_ns > _MATCH_CACHE_MIN_AGE_NS:
+            _MATCH_CACHE[cache_dir] = (mtime_ns, names)
+    matched_filenames = names.get(dir_name, [])
     if len(matched_filenames) == 0:
         return ''
     elif len(matched_filenames) == 1:
@@ -506,42 +1368,64 @@ def match_file(dir_name: str, cache_dir: Path) -> str:
         raise RuntimeError(f"Duplicate matched files:{matched_filenames}, this should be caused by a bug.")
 
 
+def _scan_match_names(cache_dir: str) -> dict:
+    r"""
+    扫描cache_dir, 返回所有可以匹配到某个文件的dir_name到文件名的映射。文件名等于dir_name, 或以dir_name + '.'开头时匹配,
+    例如glove.6B.50d.txt可以被glove, glove.6B, glove.6B.50d和glove.6B.50d.txt匹配
+
+    :param cache_dir: 需要扫描的文件夹
+    :return: dict, key为dir_name, value为匹配的文件名的list
+    """
+    names = {}
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            file_name = entry.name
+            for i, c in enumerate(file_name):
+                if c == '.' and i > 0:
+                    names.setdefault(file_name[:i], []).append(file_name)
+            names.setdefault(file_name, []).append(file_name)
+    return names
+
+
 def _get_bert_dir(model_dir_or_name: str = 'en-base-uncased'):
-    if model_dir_or_name.lower() in PRETRAINED_BERT_MODEL_DIR:
-        model_url = _get_embedding_url('bert', model_dir_or_name.lower())
+    model_name = model_dir_or_name.lower()
+    if model_name in PRETRAINED_BERT_MODEL_DIR:
+        model_url = _get_embedding_url('bert', model_name)
         model_dir = cached_path(model_url, name='embedding')
-        # 检查是否存在
-    elif os.path.isdir(os.path.abspath(os.path.expanduser(model_dir_or_name))):
-        model_dir = os.path.abspath(os.path.expanduser(model_dir_or_name))
     else:
-        logger.error(f"Cannot recognize BERT dir or name ``{model_dir_or_name}``.")
-        raise ValueError(f"Cannot recognize BERT dir or name ``{model_dir_or_name}``.")
+        # 只有不是预训练模型的名称时才需要解析本地路径, 并检查是否存在
+        model_dir = os.path.abspath(os.path.expanduser(model_dir_or_name))
+        if not os.path.isdir(model_dir):
+            logger.error(f"Cannot recognize BERT dir or name ``{model_dir_or_name}``.")
+            raise ValueError(f"Cannot recognize BERT dir or name ``{model_dir_or_name}``.")
     return str(model_dir)
 
 
 def _get_gpt2_dir(model_dir_or_name: str = 'en'):
-    if model_dir_or_name.lower() in PRETRAINED_GPT2_MODEL_DIR:
-        model_url = _get_embedding_url('gpt2', model_dir_or_name.lower())
+    model_name = model_dir_or_name.lower()
+    if model_name in PRETRAINED_GPT2_MODEL_DIR:
+        model_url = _get_embedding_url('gpt2', model_name)
         model_dir = cached_path(model_url, name='embedding')
-        # 检查是否存在
-    elif os.path.isdir(os.path.abspath(os.path.expanduser(model_dir_or_name))):
-        model_dir = os.path.abspath(os.path.expanduser(model_dir_or_name))
     else:
-        logger.error(f"Cannot recognize GPT2 dir or name ``{model_dir_or_name}``.")
-        raise ValueError(f"Cannot recognize GPT2 dir or name ``{model_dir_or_name}``.")
+        # 只有不是预训练模型的名称时才需要解析本地路径, 并检查是否存在
+        model_dir = os.path.abspath(os.path.expanduser(model_dir_or_name))
+        if not os.path.isdir(model_dir):
+            logger.error(f"Cannot recognize GPT2 dir or name ``{model_dir_or_name}``.")
+            raise ValueError(f"Cannot recognize GPT2 dir or name ``{model_dir_or_name}``.")
     return str(model_dir)
 
 
 def _get_roberta_dir(model_dir_or_name: str = 'en'):
-    if model_dir_or_name.lower() in PRETRAINED_ROBERTA_MODEL_DIR:
-        model_url = _get_embedding_url('roberta', model_dir_or_name.lower())
+    model_name = model_dir_or_name.lower()
+    if model_name in PRETRAINED_ROBERTA_MODEL_DIR:
+        model_url = _get_embedding_url('roberta', model_name)
         model_dir = cached_path(model_url, name='embedding')
-        # 检查是否存在
-    elif os.path.isdir(os.path.abspath(os.path.expanduser(model_dir_or_name))):
-        model_dir = os.path.abspath(os.path.expanduser(model_dir_or_name))
     else:
-        logger.error(f"Cannot recognize RoBERTa dir or name ``{model_dir_or_name}``.")
-        raise ValueError(f"Cannot recognize RoBERTa dir or name ``{model_dir_or_name}``.")
+        # 只有不是预训练模型的名称时才需要解析本地路径, 并检查是否存在
+        model_dir = os.path.abspath(os.path.expanduser(model_dir_or_name))
+        if not os.path.isdir(model_dir):
+            logger.error(f"Cannot recognize RoBERTa dir or name ``{model_dir_or_name}``.")
+            raise ValueError(f"Cannot recognize RoBERTa dir or name ``{model_dir_or_name}``.")
     return str(model_dir)
 
 
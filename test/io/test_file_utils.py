@@ -0,0 +1,609 @@
+import hashlib
+import http.server
+import io
+import os
+import re
+import shutil
+import socketserver
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest.mock import patch
+
+import requests
+
+from fastNLP.io import file_utils
+from fastNLP.io.file_utils import cached_path, get_filepath, match_file, split_filename_suffix, unzip_file, \
+    untar_gz_file, untar_gz_stream, _remove_stale_temp_files
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    r"""
+    从内存中返回files里的内容, 支持Range/If-Range/If-None-Match; fail_after不为None时, 每个响应只发送这么多字节就断开连接
+    """
+    files = {}
+    requests = []
+    fail_after = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        self.requests.append((self.command, self.path, dict(self.headers)))
+        data = self.files.get(self.path.split('?')[0])
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start, end = 0, len(data)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') in (None, etag):
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1, len(data)) if match.group(2) else len(data)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if send_body:
+            body = data[start:end]
+            if self.fail_after is not None and self.fail_after < len(body):
+                self.wfile.write(body[:self.fail_after])
+                self.close_connection = True
+            else:
+                self.wfile.write(body)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer在python3.7中才加入
+    daemon_threads = True
+
+
+class _ServerTestCase(unittest.TestCase):
+    r"""
+    在后台线程中启动_RangeHandler, 每个测试使用单独的cache_dir
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = _ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+        # 客户端中断下载时服务端会出现BrokenPipeError, 不需要打印
+        cls.server.handle_error = lambda request, client_address: None
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        _RangeHandler.files = {}
+        _RangeHandler.requests = []
+        _RangeHandler.fail_after = None
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _gets(self):
+        return [headers for command, path, headers in _RangeHandler.requests if command == 'GET']
+
+
+class TestMatchFile(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _touch(self, *names):
+        for name in names:
+            open(os.path.join(self.cache_dir, name), 'w').close()
+
+    def test_match(self):
+        self._touch('glove.6B.50d.txt', 'other')
+        self.assertEqual(match_file('glove.6B.50d', self.cache_dir), 'glove.6B.50d.txt')
+        self.assertEqual(match_file('other', self.cache_dir), 'other')
+        self.assertEqual(match_file('missing', self.cache_dir), '')
+
+    def test_dot_is_not_wildcard(self):
+        self._touch('glovex6B')
+        self.assertEqual(match_file('glove.6B', self.cache_dir), '')
+
+    def test_cache_invalidated_on_change(self):
+        self._touch('bert.zip')
+        os.utime(self.cache_dir, (0, 0))
+        self.assertEqual(match_file('bert', self.cache_dir), 'bert.zip')
+        self.assertEqual(match_file('elmo', self.cache_dir), '')
+        self._touch('elmo.zip')
+        self.assertEqual(match_file('elmo', self.cache_dir), 'elmo.zip')
+
+    def test_duplicate(self):
+        self._touch('bert.zip', 'bert.txt')
+        with self.assertRaises(RuntimeError):
+            match_file('bert', self.cache_dir)
+
+
+class TestSplitFilenameSuffix(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_filename_suffix('a/yelp.tar.gz'), ('yelp', '.tar.gz'))
+        self.assertEqual(split_filename_suffix('a/bert.zip'), ('bert', '.zip'))
+
+
+class TestGetFilepath(unittest.TestCase):
+    def test_get_filepath(self):
+        folder = tempfile.mkdtemp()
+        try:
+            self.assertEqual(get_filepath(folder), folder)
+            open(os.path.join(folder, 'a.txt'), 'w').close()
+            self.assertEqual(get_filepath(folder), os.path.join(folder, 'a.txt'))
+            self.assertEqual(get_filepath(os.path.join(folder, 'a.txt')), os.path.join(folder, 'a.txt'))
+            open(os.path.join(folder, 'b.txt'), 'w').close()
+            self.assertEqual(get_filepath(folder), folder)
+            with self.assertRaises(FileNotFoundError):
+                get_filepath(os.path.join(folder, 'c.txt'))
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestRemoveStaleTempFiles(unittest.TestCase):
+    def test_remove(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(cache_dir, '.tmpold', 'sub'))
+            for name in ('.tmpold.zip', '.tmpnew', 'bert.zip'):
+                open(os.path.join(cache_dir, name), 'w').close()
+            for name in ('.tmpold', '.tmpold.zip', 'bert.zip'):
+                os.utime(os.path.join(cache_dir, name), (0, 0))
+            _remove_stale_temp_files(cache_dir)
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['.tmpnew', 'bert.zip'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+def _make_tar_gz(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class TestResumeDownload(_ServerTestCase):
+    def _interrupt_then_resume(self, name, data, fail_after):
+        _RangeHandler.files['/' + name] = data
+        _RangeHandler.fail_after = fail_after
+        # 流式解压时抛出的是urllib3的异常
+        with self.assertRaises(Exception):
+            cached_path(self.base_url + name, cache_dir=self.cache_dir)
+        self.assertFalse([name for name in os.listdir(self.cache_dir) if not name.startswith('.')])
+
+        _RangeHandler.fail_after = None
+        _RangeHandler.requests = []
+        return cached_path(self.base_url + name, cache_dir=self.cache_dir)
+
+    def test_resume(self):
+        data = os.urandom(3 * 1024 * 1024)
+        path = self._interrupt_then_resume('data.bin', data, 2 * 1024 * 1024)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        gets = self._gets()
+        self.assertEqual(len(gets), 1)
+        self.assertRegex(gets[0]['Range'], r'^bytes=[1-9]\d*-$')
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, '.partials')), [])
+
+    def test_resume_preallocated(self):
+        # 进程在预分配之后被kill时, 文件的大小是完整的大小, 应该从.offset中记录的位置继续下载
+        data = os.urandom(3 * 1024 * 1024)
+        _RangeHandler.files['/data.bin'] = data
+        partial_path = file_utils._get_partial_path(self.cache_dir, self.base_url + 'data.bin')
+        with open(partial_path, 'wb') as f:
+            f.write(data[:1024 * 1024] + bytes(len(data) - 1024 * 1024))
+        file_utils._write_partial_offset(partial_path, 1024 * 1024)
+        self._write_validator(partial_path, data)
+        path = cached_path(self.base_url + 'data.bin', cache_dir=self.cache_dir)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self._gets()[0]['Range'], 'bytes=1048576-')
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, '.partials')), [])
+
+    def _write_validator(self, partial_path, data):
+        with open(partial_path + '.validator', 'w') as f:
+            f.write('"%s"' % hashlib.md5(data).hexdigest())
+
+    def _write_partial(self, name, content, data):
+        partial_path = file_utils._get_partial_path(self.cache_dir, self.base_url + name)
+        with open(partial_path, 'wb') as f:
+            f.write(content)
+        if data is not None:
+            self._write_validator(partial_path, data)
+
+    def test_no_resume_without_validator(self):
+        data = os.urandom(1024)
+        _RangeHandler.files['/data.bin'] = data
+        self._write_partial('data.bin', bytes(100), None)
+        path = cached_path(self.base_url + 'data.bin', cache_dir=self.cache_dir)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(len(self._gets()), 1)
+        self.assertNotIn('Range', self._gets()[0])
+
+    def test_resume_complete_partial(self):
+        # 下载完成之后在解压时被中断, 服务器返回416且文件大小与已下载的一致, 直接使用已下载的文件
+        data = os.urandom(1024)
+        _RangeHandler.files['/data.bin'] = data
+        self._write_partial('data.bin', data, data)
+        path = cached_path(self.base_url + 'data.bin', cache_dir=self.cache_dir)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual([headers.get('Range') for headers in self._gets()], ['bytes=1024-'])
+
+    def test_resume_oversized_partial(self):
+        data = os.urandom(1024)
+        _RangeHandler.files['/data.bin'] = data
+        self._write_partial('data.bin', data + data, data)
+        path = cached_path(self.base_url + 'data.bin', cache_dir=self.cache_dir)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual([headers.get('Range') for headers in self._gets()], ['bytes=2048-', None])
+
+    def test_resume_streamed_tar_gz(self):
+        files = {'pkg/a.bin': os.urandom(3 * 1024 * 1024), 'pkg/b.txt': b'b'}
+        with patch.object(file_utils, '_RESUMABLE_STREAM_THRESHOLD', 0):
+            path = self._interrupt_then_resume('pkg.tar.gz', _make_tar_gz(files), 2 * 1024 * 1024)
+        for name, data in files.items():
+            with open(os.path.join(path, os.path.basename(name)), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        self.assertRegex(self._gets()[0]['Range'], r'^bytes=[1-9]\d*-$')
+
+    def test_small_streamed_tar_gz_not_kept(self):
+        # 较小的压缩包只一边下载一边解压, 不写入.partials
+        files = {'pkg/a.bin': os.urandom(3 * 1024 * 1024), 'pkg/b.txt': b'b'}
+        path = self._interrupt_then_resume('pkg.tar.gz', _make_tar_gz(files), 2 * 1024 * 1024)
+        self.assertEqual(sorted(os.listdir(path)), ['a.bin', 'b.txt'])
+        self.assertNotIn('Range', self._gets()[0])
+
+    def test_resume_parallel(self):
+        data = os.urandom(8 * 1024 * 1024)
+        with patch.object(file_utils, '_PARALLEL_DOWNLOAD_THRESHOLD', 0):
+            path = self._interrupt_then_resume('data.bin', data, 3 * 1024 * 1024 // 2)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        # 第一个GET用于获取文件大小, 之后每一段只请求中断时剩余的部分(第一段失败时其它段会停止, 剩余的部分可能是整段)
+        gets = self._gets()
+        self.assertNotIn('Range', gets[0])
+        part_size = len(data) // file_utils._PARALLEL_DOWNLOAD_WORKERS
+        requested = 0
+        for headers in gets[1:]:
+            start, end = map(int, re.match(r'bytes=(\d+)-(\d+)$', headers['Range']).groups())
+            self.assertEqual(end % part_size, part_size - 1)
+            self.assertEqual(headers['If-Range'], '"%s"' % hashlib.md5(data).hexdigest())
+            requested += end - start + 1
+        self.assertLessEqual(requested, len(data) - 1024 * 1024)
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, '.partials')), [])
+
+
+def _list_files(folder):
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, _, names in os.walk(folder) for name in names)
+
+
+class TestUnzipFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_unzip(self):
+        zip_path = os.path.join(self.folder, 'pkg.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr('pkg/', '')
+            zf.writestr('pkg/empty/', '')
+            zf.writestr('pkg/a.txt', 'a' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+            for i in range(20):
+                zf.writestr(f'pkg/b{i % 3}/c{i % 4}/{i}.bin', os.urandom(i * 1000))
+            zf.writestr('../evil.txt', 'evil')
+        expected = os.path.join(self.folder, 'expected')
+        with zipfile.ZipFile(zip_path) as zf:
+            zf.extractall(expected)
+
+        to = os.path.join(self.folder, 'to')
+        # 不使用libarchive, 测试多线程解压
+        with patch.object(file_utils, 'libarchive', None), patch.object(file_utils, '_UNZIP_WORKERS', 4):
+            unzip_file(zip_path, to)
+        self.assertEqual(_list_files(to), _list_files(expected))
+        self.assertIn('evil.txt', os.listdir(to))
+        self.assertTrue(os.path.isdir(os.path.join(to, 'pkg', 'empty')))
+        for name in _list_files(expected):
+            with open(os.path.join(to, name), 'rb') as f1, open(os.path.join(expected, name), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+
+class TestUntarGz(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_untar_gz(self):
+        files = {'pkg/a.txt': b'a', 'pkg/sub/b.bin': os.urandom(100000)}
+        tar_path = os.path.join(self.folder, 'pkg.tar.gz')
+        with open(tar_path, 'wb') as f:
+            f.write(_make_tar_gz(files))
+
+        with patch.object(file_utils, 'libarchive', None):
+            untar_gz_file(tar_path, os.path.join(self.folder, 'file'))
+        with open(tar_path, 'rb') as f:
+            untar_gz_stream(f, os.path.join(self.folder, 'stream'))
+        for to in ('file', 'stream'):
+            for name, data in files.items():
+                with open(os.path.join(self.folder, to, name), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_untar_gz_rejects_outside_paths(self):
+        if not hasattr(tarfile, 'data_filter'):
+            self.skipTest("tarfile filters are not available")
+        tar_path = os.path.join(self.folder, 'evil.tar.gz')
+        with open(tar_path, 'wb') as f:
+            f.write(_make_tar_gz({'../evil.txt': b'evil'}))
+        with patch.object(file_utils, 'libarchive', None), self.assertRaises(tarfile.TarError):
+            untar_gz_file(tar_path, os.path.join(self.folder, 'to'))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'evil.txt')))
+
+
+class TestRefresh(_ServerTestCase):
+    def test_refresh(self):
+        _RangeHandler.files['/data.txt'] = b'old'
+        path = cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir)
+
+        # 没有更新时服务器返回304, 不重新下载
+        _RangeHandler.requests = []
+        self.assertEqual(cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir, refresh=True), path)
+        self.assertEqual([command for command, _, _ in _RangeHandler.requests], ['HEAD'])
+        self.assertIn('If-None-Match', _RangeHandler.requests[0][2])
+
+        # 有更新时服务器返回200, 重新下载
+        _RangeHandler.files['/data.txt'] = b'new'
+        _RangeHandler.requests = []
+        self.assertEqual(cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir, refresh=True), path)
+        self.assertEqual([command for command, _, _ in _RangeHandler.requests], ['HEAD', 'GET'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+    def test_refresh_unreachable(self):
+        _RangeHandler.files['/data.txt'] = b'old'
+        path = cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir)
+        # 无法连接服务器时继续使用已有的缓存
+        with patch.object(file_utils._get_session(), 'head', side_effect=requests.ConnectionError):
+            self.assertEqual(cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir, refresh=True), path)
+
+    def test_refresh_corrupt_etag(self):
+        _RangeHandler.files['/data.txt'] = b'old'
+        path = cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir)
+        with open(os.path.join(self.cache_dir, '.data.etag.json'), 'w') as f:
+            f.write('{')
+        _RangeHandler.requests = []
+        self.assertEqual(cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir, refresh=True), path)
+        self.assertEqual(_RangeHandler.requests, [])
+
+
+class TestResolvedPaths(_ServerTestCase):
+    def test_memo_invalidated_when_deleted(self):
+        _RangeHandler.files['/data.txt'] = b'data'
+        path = cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir)
+        self.assertEqual(cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir), path)
+        self.assertEqual(len(self._gets()), 1)
+
+        os.remove(path)
+        self.assertEqual(cached_path(self.base_url + 'data.txt', cache_dir=self.cache_dir), path)
+        self.assertEqual(len(self._gets()), 2)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_bounded(self):
+        for i in range(3):
+            open(os.path.join(self.cache_dir, f'{i}.txt'), 'w').close()
+        with patch.object(file_utils, '_RESOLVED_PATHS', file_utils.OrderedDict()), \
+                patch.object(file_utils, '_RESOLVED_PATHS_MAXSIZE', 2):
+            cached_path('0.txt', cache_dir=self.cache_dir)
+            cached_path('1.txt', cache_dir=self.cache_dir)
+            cached_path('0.txt', cache_dir=self.cache_dir)
+            cached_path('2.txt', cache_dir=self.cache_dir)
+            # 1.txt是最久没有使用的, 被丢弃
+            self.assertEqual([key[0] for key in file_utils._RESOLVED_PATHS], ['0.txt', '2.txt'])
+
+
+class _SlowSession:
+    r"""
+    替代requests.Session: 第一段每个chunk之间等待一段时间, 最后一段直接返回500
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.first_part_chunks = 0
+
+    def get(self, url, stream=True, headers=None):
+        start, end = map(int, re.match(r'bytes=(\d+)-(\d+)$', headers['Range']).groups())
+        response = requests.Response()
+        response.raw = io.BytesIO()
+        if end == self.total - 1:
+            response.status_code = 500
+            return response
+        response.status_code = 206
+        response.iter_content = lambda chunk_size: self._iter_chunks(start, end, slow=start == 0)
+        return response
+
+    def _iter_chunks(self, start, end, slow):
+        for offset in range(start, end + 1, 1024):
+            if slow:
+                time.sleep(0.05)
+                self.first_part_chunks += 1
+            yield bytes(min(1024, end + 1 - offset))
+
+
+class TestDownloadInParallel(unittest.TestCase):
+    def test_stop_on_first_failure(self):
+        folder = tempfile.mkdtemp()
+        try:
+            total = 4 * 100 * 1024
+            session = _SlowSession(total)
+            start = time.time()
+            with self.assertRaises(requests.HTTPError):
+                file_utils._download_in_parallel(session, 'http://fastnlp/data.bin', os.path.join(folder, 'data.bin'),
+                                                 total, file_utils._BatchedProgress(total), '"etag"')
+            # 第一段需要5秒才能下载完成, 最后一段失败之后它应该在当前chunk之后停止
+            self.assertLess(time.time() - start, 1)
+            self.assertLess(session.first_part_chunks, 20)
+        finally:
+            shutil.rmtree(folder)
+
+
+def _make_tar_zst(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return file_utils.zstandard.ZstdCompressor().compress(buffer.getvalue())
+
+
+def _make_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+@unittest.skipIf(file_utils.zstandard is None, "zstandard is not installed")
+class TestZstArchive(_ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        _RangeHandler.files['/pkg.zip'] = _make_zip({'pkg/a.txt': b'zip', 'pkg/b.txt': b'b'})
+        # 只有fastNLP的下载地址才会检查是否存在.tar.zst版本
+        environ = patch.dict(os.environ, {'FASTNLP_EMBEDDING_URL': self.base_url})
+        failed_urls = patch.object(file_utils, '_ZST_FAILED_URLS', set())
+        for patcher in (environ, failed_urls):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _read(self, path):
+        with open(os.path.join(path, 'a.txt'), 'rb') as f:
+            return f.read()
+
+    def _requests(self):
+        return [(command, path) for command, path, _ in _RangeHandler.requests]
+
+    def test_prefer_zst(self):
+        _RangeHandler.files['/pkg.tar.zst'] = _make_tar_zst({'pkg/a.txt': b'zst', 'pkg/b.txt': b'b'})
+        path = cached_path(self.base_url + 'pkg.zip?v=1', cache_dir=self.cache_dir)
+        self.assertEqual(self._read(path), b'zst')
+        self.assertEqual(self._requests(), [('HEAD', '/pkg.tar.zst?v=1'), ('GET', '/pkg.tar.zst?v=1')])
+
+    def test_fallback_on_corrupt_zst(self):
+        _RangeHandler.files['/pkg.tar.zst'] = _make_tar_zst({'pkg/a.txt': b'zst', 'pkg/b.txt': b'b'})[:20]
+        path = cached_path(self.base_url + 'pkg.zip', cache_dir=self.cache_dir)
+        self.assertEqual(self._read(path), b'zip')
+        self.assertEqual(self._requests(), [('HEAD', '/pkg.tar.zst'), ('GET', '/pkg.tar.zst'), ('GET', '/pkg.zip')])
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, '.partials')), [])
+
+        # 解压失败过的url之后不再检查.tar.zst
+        shutil.rmtree(path)
+        _RangeHandler.requests = []
+        path = cached_path(self.base_url + 'pkg.zip', cache_dir=self.cache_dir)
+        self.assertEqual(self._read(path), b'zip')
+        self.assertEqual(self._requests(), [('GET', '/pkg.zip')])
+
+    def test_no_zst(self):
+        path = cached_path(self.base_url + 'pkg.zip', cache_dir=self.cache_dir)
+        self.assertEqual(self._read(path), b'zip')
+        self.assertEqual(self._requests(), [('HEAD', '/pkg.tar.zst'), ('GET', '/pkg.zip')])
+
+    def test_other_url_not_probed(self):
+        with patch.dict(os.environ, {'FASTNLP_EMBEDDING_URL': self.base_url + 'embedding/'}):
+            path = cached_path(self.base_url + 'pkg.zip', cache_dir=self.cache_dir)
+        self.assertEqual(self._read(path), b'zip')
+        self.assertEqual(self._requests(), [('GET', '/pkg.zip')])
+
+    def test_untar_zst_file(self):
+        files = {'pkg/a.txt': b'a', 'pkg/sub/b.bin': os.urandom(100000)}
+        zst_path = os.path.join(self.cache_dir, 'pkg.tar.zst')
+        with open(zst_path, 'wb') as f:
+            f.write(_make_tar_zst(files))
+        with patch.object(file_utils, 'libarchive', None):
+            file_utils.untar_zst_file(zst_path, os.path.join(self.cache_dir, 'to'))
+        for name, data in files.items():
+            with open(os.path.join(self.cache_dir, 'to', name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+
+class _ChunkResponse:
+    r"""
+    替代requests.Response, iter_content依次返回chunks, 遇到Exception时抛出
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class TestIterContentInBackground(unittest.TestCase):
+    def test_order(self):
+        chunks = [os.urandom(10) for _ in range(100)]
+        req = _ChunkResponse(chunks[:50] + [b''] + chunks[50:])
+        self.assertEqual(list(file_utils._iter_content_in_background(req)), chunks)
+
+    def test_error(self):
+        req = _ChunkResponse([b'a', b'b', IOError('broken')])
+        received = []
+        with self.assertRaises(IOError):
+            for chunk in file_utils._iter_content_in_background(req):
+                received.append(chunk)
+        self.assertEqual(received, [b'a', b'b'])
+        self.assertTrue(req.closed)
+
+    def test_stop_early(self):
+        req = _ChunkResponse([b'a'] * 1000)
+        chunks = file_utils._iter_content_in_background(req)
+        self.assertEqual(next(chunks), b'a')
+        chunks.close()
+        # 写入失败时关闭连接, 让后台线程尽快退出
+        self.assertTrue(req.closed)